@@ -6,7 +6,8 @@ import simplejson as json  # Нужн для корректной сериали
 from flask import Blueprint, jsonify, request
 from .models import Patient, PatientNew, Payment, PaymentNew, PatientStats
 from .models import db, patients_schema, payments_schema
-from .models import create_table, swap_and_drop_table, calculate_stats
+from .models import use_current_generations, create_table, publish_table, drop_old_generations
+from .models import calculate_stats
 
 api = Blueprint('api', __name__)
 
@@ -43,6 +44,7 @@ def patients_get():
     payments_max = request.args.get('payments_max', type=float)
     current_page = request.args.get('page', default=1, type=int)
 
+    use_current_generations(db.session)
     query = Patient.query
     if payment_min is not None or payments_max is not None:
         query = query.join(PatientStats, PatientStats.patient_id == Patient.external_id)
@@ -64,6 +66,7 @@ def patients_post():
     # Весь код ниже - мое первое знакомство с Flask и SQLAlchemy,
     # и в реальном сервисе использоваться не должен
     if request.is_json:
+        use_current_generations(db.session)
         create_table(db.session, table=Patient.__tablename__)
 
         objects = []
@@ -79,7 +82,10 @@ def patients_post():
         db.session.bulk_save_objects(objects)
         objects.clear()
 
-        swap_and_drop_table(db.session, table=Patient.__tablename__)
+        publish_table(db.session, table=Patient.__tablename__)
+        db.session.commit()
+
+        drop_old_generations(db.session, table=Patient.__tablename__)
         db.session.commit()
         return jsonify({'status': 'OK'}), 201
     return jsonify({'status': 'error'}), 422
@@ -90,6 +96,7 @@ def payments_get():
     patient_id = request.args.get('patient_id', type=str)
     current_page = request.args.get('page', default=1, type=int)
 
+    use_current_generations(db.session)
     query = Payment.query.order_by(Payment.id)
     if external_id is not None:
         query = query.filter(Payment.external_id == external_id)
@@ -102,6 +109,7 @@ def payments_get():
 
 def payments_post():
     if request.is_json:
+        use_current_generations(db.session)
         create_table(db.session, table=Payment.__tablename__)
         create_table(db.session, table=PatientStats.__tablename__, has_trigger=False)
 
@@ -118,8 +126,12 @@ def payments_post():
         objects.clear()
 
         calculate_stats(db.session)
-        swap_and_drop_table(db.session, table=Payment.__tablename__)
-        swap_and_drop_table(db.session, table=PatientStats.__tablename__)
+        publish_table(db.session, table=Payment.__tablename__)
+        publish_table(db.session, table=PatientStats.__tablename__)
+        db.session.commit()
+
+        drop_old_generations(db.session, table=Payment.__tablename__)
+        drop_old_generations(db.session, table=PatientStats.__tablename__)
         db.session.commit()
         return jsonify({'status': 'OK'}), 201
     return jsonify({'status': 'error'}), 422
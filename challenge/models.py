@@ -1,12 +1,19 @@
 # pylint: disable=R0903,C0111,C0103,R0913
 
-from sqlalchemy import Column, DateTime, Date, BigInteger, Text, DECIMAL, DDL, func, event
+import time
+
+from psycopg2.errorcodes import LOCK_NOT_AVAILABLE
+from sqlalchemy import Column, DateTime, Date, BigInteger, Text, DECIMAL, DDL, Sequence, func, event
+from sqlalchemy.exc import OperationalError
 from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
 
 db = SQLAlchemy()
 ma = Marshmallow()
 
+LOCK_TIMEOUT = '100ms'
+LOCK_RETRIES = 10
+
 
 class Base(db.Model):
     __abstract__ = True
@@ -70,6 +77,17 @@ class PatientStats(db.Model):
     total_amount = Column(DECIMAL(precision=10, scale=2), nullable=False, index=True)
 
 
+# Указатель на опубликованное поколение таблицы. Каждый импорт заливается в свою схему
+# <table>_g<generation>, а читатели через search_path смотрят на текущее поколение.
+# Предыдущее поколение хранится до следующего импорта, см. drop_old_generations()
+class Dataset(db.Model):
+    __tablename__ = 'datasets'
+
+    name = Column(Text, primary_key=True)
+    generation = Column(BigInteger, Sequence('datasets_generation_seq'), nullable=False)
+    previous = Column(BigInteger)
+
+
 class PatientSchema(ma.ModelSchema):
     class Meta:
         model = Patient
@@ -212,24 +230,90 @@ event.listen(
 )
 
 
+def use_current_generations(connection):
+    """ Point search_path of the current transaction to the published generations
+        and hold them until the end of the transaction, see drop_old_generations() """
+    connection.execute("SELECT set_config('search_path', concat_ws(', ', " +
+                       "string_agg(quote_ident(name || '_g' || generation), ', '), 'public'), true) " +
+                       "FROM public.datasets, LATERAL (SELECT pg_advisory_xact_lock_shared(generation)) AS hold")
+
+
 def create_table(connection, table, has_trigger=True):
     """ Create a new table """
-    connection.execute("DROP TABLE IF EXISTS {0}_new".format(table))
-    connection.execute("CREATE TABLE {0}_new (LIKE {0} INCLUDING ALL)".format(table))
+    connection.execute("DROP TABLE IF EXISTS public.{0}_new".format(table))
+    connection.execute("CREATE TABLE public.{0}_new (LIKE public.{0} INCLUDING ALL)".format(table))
     if has_trigger:
         connection.execute("CREATE TRIGGER %s_before_insert_trigger " % table +
-                           "BEFORE INSERT ON %s_new " % table +
+                           "BEFORE INSERT ON public.%s_new " % table +
                            "FOR EACH ROW EXECUTE PROCEDURE %s_insert_trigger_func()" % table)
 
 
-def swap_and_drop_table(connection, table):
-    """ Swap a new and an old tables and then removes an old one """
-    connection.execute("ANALYSE {0}_new".format(table))
-    connection.execute("ALTER TABLE IF EXISTS {0}_sub NO INHERIT {0}".format(table))
-    connection.execute("ALTER TABLE IF EXISTS {0}_sub RENAME TO {0}_old".format(table))
-    connection.execute("ALTER TABLE IF EXISTS {0}_new RENAME TO {0}_sub".format(table))
-    connection.execute("ALTER TABLE IF EXISTS {0}_sub INHERIT {0}".format(table))
-    connection.execute("DROP TABLE IF EXISTS {0}_old".format(table))
+def execute_with_lock_timeout(connection, statement, retries=LOCK_RETRIES):
+    """ Execute a statement with a short lock_timeout, retrying while the lock is busy """
+    for attempt in range(retries):
+        connection.execute("SAVEPOINT lock_timeout")
+        connection.execute("SET LOCAL lock_timeout = '%s'" % LOCK_TIMEOUT)
+        try:
+            connection.execute(statement)
+        except OperationalError as e:
+            connection.execute("ROLLBACK TO SAVEPOINT lock_timeout")
+            if e.orig.pgcode != LOCK_NOT_AVAILABLE or attempt == retries - 1:
+                raise
+            time.sleep(0.05 * (attempt + 1))
+            continue
+        connection.execute("SET LOCAL lock_timeout = DEFAULT")
+        connection.execute("RELEASE SAVEPOINT lock_timeout")
+        return
+
+
+def publish_generation(connection, table, source):
+    """ Move a table into a new generation schema and make it the current one """
+    generation = connection.execute("SELECT nextval('datasets_generation_seq')").scalar()
+    schema = "{0}_g{1}".format(table, generation)
+    connection.execute("CREATE SCHEMA {0}".format(schema))
+    connection.execute("ALTER TABLE public.{0} SET SCHEMA {1}".format(source, schema))
+    connection.execute("ALTER TABLE {1}.{0} RENAME TO {2}".format(source, schema, table))
+    # Переключение - это обновление одной строки, SELECT читателей его не блокирует
+    execute_with_lock_timeout(connection,
+                              "INSERT INTO public.datasets (name, generation) " +
+                              "VALUES ('{0}', {1}) ON CONFLICT (name) DO UPDATE ".format(table, generation) +
+                              "SET previous = datasets.generation, generation = EXCLUDED.generation")
+
+
+def publish_table(connection, table):
+    """ Publish a new table as the current generation """
+    # Все ALTER выполняются над еще не опубликованной таблицей, читатели их не ждут
+    connection.execute("ANALYSE public.{0}_new".format(table))
+    publish_generation(connection, table, source=table + '_new')
+
+
+def drop_old_generations(connection, table):
+    """ Drop generations of a table that are neither current nor previous and not being read """
+    # Предыдущее поколение не трогаем: читатель мог прочитать указатель до переключения,
+    # но еще не успеть взять advisory lock
+    schemas = connection.execute("SELECT nspname FROM pg_namespace, public.datasets " +
+                                 "WHERE name = '{0}' AND nspname ~ '^{0}_g[0-9]+$' ".format(table) +
+                                 "AND nspname <> name || '_g' || generation " +
+                                 "AND nspname <> name || '_g' || coalesce(previous, generation)").fetchall()
+    for (schema,) in schemas:
+        generation = int(schema.rsplit('_g', 1)[1])
+        # Поколение держат читатели - удалим при следующем импорте
+        if not connection.execute("SELECT pg_try_advisory_xact_lock({0})".format(generation)).scalar():
+            continue
+        try:
+            execute_with_lock_timeout(connection, "DROP SCHEMA {0} CASCADE".format(schema), retries=1)
+        except OperationalError as e:
+            # Таблицу держит запрос в обход use_current_generations() - тоже откладываем
+            if e.orig.pgcode != LOCK_NOT_AVAILABLE:
+                raise
+
+
+def adopt_legacy_table(connection, table):
+    """ Publish a child table left over from the inheritance-based swap as the first generation """
+    if connection.execute("SELECT to_regclass('public.{0}_sub')".format(table)).scalar() is None:
+        return
+    execute_with_lock_timeout(connection, "ALTER TABLE public.{0}_sub NO INHERIT public.{0}".format(table))
+    publish_generation(connection, table, source=table + '_sub')
 
 
 def calculate_stats(connection):
@@ -10,7 +10,8 @@ import ijson
 from flask_script import Manager, Server
 from flask_script.commands import ShowUrls, Clean
 from challenge import create_app, db
-from challenge.models import create_table, swap_and_drop_table, calculate_stats
+from challenge.models import use_current_generations, create_table, publish_table, drop_old_generations
+from challenge.models import adopt_legacy_table, calculate_stats
 
 # default to dev config because no one should use this in
 # production anyway
@@ -41,6 +42,20 @@ def createdb():
     db.create_all()
 
 
+@manager.command
+def adopt_legacy_tables():
+    """ Publishes *_sub tables of the inheritance-based swap
+        as the first generations
+    """
+
+    con = db.engine.connect()
+    trx = con.begin()
+    for table in ('patients', 'payments', 'patients_stats'):
+        adopt_legacy_table(con, table)
+    trx.commit()
+    con.close()
+
+
 @manager.command
 @manager.option('-f', '--file', help='File patch', dest='file')
 def import_patients(file='patients.json'):
@@ -64,13 +79,17 @@ def import_patients(file='patients.json'):
     csv_file = open(csv_patch, 'rb')
     con = db.engine.connect()
     trx = con.begin()
+    use_current_generations(con)
     create_table(con, 'patients')
     cur = con.connection.cursor()
     cur.copy_from(csv_file, 'patients_new', sep=',',
                   columns=('external_id', 'first_name', 'last_name', 'date_of_birth'))
     cur.close()  # ???
     print("Загружено за %s секунд" % (time.time() - t))
-    swap_and_drop_table(con, 'patients')
+    publish_table(con, 'patients')
+    trx.commit()
+    trx = con.begin()
+    drop_old_generations(con, 'patients')
     trx.commit()
     con.close()
     csv_file.close()
@@ -98,6 +117,7 @@ def import_payments(file='payments.json'):
     csv_file = open(csv_patch, 'rb')
     con = db.engine.connect()
     trx = con.begin()
+    use_current_generations(con)
     create_table(con, 'payments')
     create_table(con, 'patients_stats', has_trigger=False)
     cur = con.connection.cursor()
@@ -106,8 +126,12 @@ def import_payments(file='payments.json'):
     cur.close()  # ???
     print("Загружено за %s секунд" % (time.time() - t))
     calculate_stats(con)
-    swap_and_drop_table(con, 'payments')
-    swap_and_drop_table(con, 'patients_stats')
+    publish_table(con, 'payments')
+    publish_table(con, 'patients_stats')
+    trx.commit()
+    trx = con.begin()
+    drop_old_generations(con, 'payments')
+    drop_old_generations(con, 'patients_stats')
     trx.commit()
     con.close()
     csv_file.close()
@@ -125,6 +149,7 @@ def import_patients_slow(file='patients.json'):
     json_file = open(file, 'rb')
     con = db.engine.connect()
     trx = con.begin()
+    use_current_generations(con)
     create_table(con, 'patients')
     con.execute("PREPARE p1 (text, text, text, date) AS " +
                 "INSERT INTO patients_new (external_id, first_name, last_name, date_of_birth) " +
@@ -134,7 +159,10 @@ def import_patients_slow(file='patients.json'):
                                                     patient['firstName'],
                                                     patient['lastName'],
                                                     patient['dateOfBirth']))
-    swap_and_drop_table(con, 'patients')
+    publish_table(con, 'patients')
+    trx.commit()
+    trx = con.begin()
+    drop_old_generations(con, 'patients')
     trx.commit()
     con.close()
     json_file.close()